@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import io
 import numpy as np
 import pyaudio
@@ -20,11 +21,15 @@ SOUNDS = {
 }
 
 
-def force_codec(pc, sender, forced_codec='video/VP9', stream_type="video"):
+@functools.lru_cache
+def get_codecs(stream_type, mime_type):
   codecs = RTCRtpSender.getCapabilities(stream_type).codecs
-  codec = [codec for codec in codecs if codec.mimeType == forced_codec]
+  return tuple(codec for codec in codecs if codec.mimeType == mime_type)
+
+
+def force_codec(pc, sender, forced_codec='video/VP9', stream_type="video"):
   transceiver = next(t for t in pc.getTransceivers() if t.sender == sender)
-  transceiver.setCodecPreferences(codec)
+  transceiver.setCodecPreferences(list(get_codecs(stream_type, forced_codec)))
 
 
 class EncodedBodyVideo(MediaStreamTrack):
@@ -40,8 +45,16 @@ class EncodedBodyVideo(MediaStreamTrack):
     self.sock = messaging.sub_sock(sock_name, None, conflate=True)
     self.pts = 0
 
+  def stop(self):
+    if self.readyState == "live":
+      super().stop()
+      # SubSocket has no close(), dropping the last reference closes it
+      del self.sock
+
   async def recv(self) -> Packet:
     while True:
+      if self.readyState != "live":
+        raise MediaStreamError
       msg = messaging.recv_one_or_none(self.sock)
       if msg is not None:
         break
@@ -123,9 +136,35 @@ class BodyMic(AudioStreamTrack):
     self.codec.channels = 2
     self.audio_samples = 0
     self.chunk_number = 0
+    self.reading = False
+
+  def close_mic(self):
+    if self.mic_stream is not None:
+      self.mic_stream.stop_stream()
+      self.mic_stream.close()
+      self.mic_stream = None
+      self.p.terminate()
+
+  def stop(self):
+    super().stop()
+    # a read in flight owns the stream, recv closes it once the read returns
+    if not self.reading:
+      self.close_mic()
 
   async def recv(self):
-    mic_data = self.mic_stream.read(self.CHUNK)
+    if self.readyState != "live":
+      raise MediaStreamError
+
+    # blocking read of a full 20ms chunk, keep it off the event loop
+    self.reading = True
+    try:
+      mic_data = await asyncio.get_running_loop().run_in_executor(None, self.mic_stream.read, self.CHUNK)
+    finally:
+      self.reading = False
+    if self.readyState != "live":
+      self.close_mic()
+      raise MediaStreamError
+
     mic_sound = AudioSegment(mic_data, sample_width=2, channels=1, frame_rate=self.RATE)
     mic_sound = AudioSegment.from_mono_audiosegments(mic_sound, mic_sound)
     mic_sound += 3  # increase volume by 3db
@@ -139,9 +178,17 @@ class BodyMic(AudioStreamTrack):
 
 async def play_sound(sound):
   chunk = 5120
+  loop = asyncio.get_running_loop()
+  done = asyncio.Event()
   with wave.open(SOUNDS[sound], 'rb') as wf:
+    frame_size = wf.getsampwidth() * wf.getnchannels()
+
     def callback(in_data, frame_count, time_info, status):
       data = wf.readframes(frame_count)
+      if len(data) < frame_count * frame_size:
+        # callback runs on the portaudio thread, wake up the event loop from there
+        loop.call_soon_threadsafe(done.set)
+        return data, pyaudio.paComplete
       return data, pyaudio.paContinue
 
     p = pyaudio.PyAudio()
@@ -151,9 +198,20 @@ async def play_sound(sound):
                     output=True,
                     frames_per_buffer=chunk,
                     stream_callback=callback)
+
+    async def wait_playback():
+      await done.wait()
+      # the last buffer is still playing, wait it out instead of blocking in stop_stream
+      await asyncio.sleep(stream.get_output_latency() + chunk / wf.getframerate())
+
+    def cleanup():
+      stream.stop_stream()
+      stream.close()
+      p.terminate()
+
     stream.start_stream()
-    while stream.is_active():
-      await asyncio.sleep(0)
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
+    try:
+      await asyncio.wait_for(wait_playback(), timeout=wf.getnframes() / wf.getframerate() + 1.0)
+    except asyncio.TimeoutError:
+      pass
+    await loop.run_in_executor(None, cleanup)
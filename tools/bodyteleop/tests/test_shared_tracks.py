@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import asyncio
+import gc
+import unittest
+import weakref
+
+# web resets the warning filters before importing aiortc, which warns on import
+from openpilot.tools.bodyteleop import web
+
+from aiortc import RTCPeerConnection
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+
+class FakeSource(MediaStreamTrack):
+  kind = "video"
+
+  def __init__(self):
+    super().__init__()
+    self.frames = 0
+
+  async def recv(self):
+    if self.readyState != "live":
+      raise MediaStreamError
+    await asyncio.sleep(0.001)
+    self.frames += 1
+    return self.frames
+
+
+class TestSharedTracks(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    web.sources.clear()
+    web.subscribers.clear()
+    web.pc_tracks.clear()
+    web.pcs.clear()
+    self.created = []
+
+  async def asyncTearDown(self):
+    await web.on_shutdown(None)
+    # let relay readers see their stopped sources
+    await asyncio.sleep(0.01)
+
+  def factory(self):
+    source = FakeSource()
+    self.created.append(weakref.ref(source))
+    return source
+
+  def connect(self):
+    pc = RTCPeerConnection()
+    track = web.subscribe_shared('video', self.factory)
+    web.pcs.add(pc)
+    web.pc_tracks[pc] = [('video', track)]
+    return pc, track
+
+  async def test_source_reused(self):
+    _, track1 = self.connect()
+    _, track2 = self.connect()
+    self.assertEqual(len(self.created), 1)
+    frame1, frame2 = await asyncio.gather(track1.recv(), track2.recv())
+    self.assertEqual(frame1, frame2)
+
+  async def test_stop_on_last_unsubscribe(self):
+    pc1, track1 = self.connect()
+    pc2, track2 = self.connect()
+    await asyncio.gather(track1.recv(), track2.recv())
+    source = self.created[0]()
+
+    await web.close_pc(pc1)
+    self.assertEqual(source.readyState, "live")
+    self.assertIn('video', web.sources)
+
+    await web.close_pc(pc2)
+    self.assertEqual(source.readyState, "ended")
+    self.assertEqual(web.sources, {})
+    self.assertEqual(web.subscribers, {})
+
+    await asyncio.sleep(0.01)
+    frames = source.frames
+    await asyncio.sleep(0.01)
+    self.assertEqual(source.frames, frames)
+
+  async def test_double_close_pc(self):
+    pc1, _ = self.connect()
+    _, track2 = self.connect()
+    await web.close_pc(pc1)
+    await web.close_pc(pc1)
+    self.assertEqual(self.created[0]().readyState, "live")
+    self.assertEqual(len(web.subscribers['video']), 1)
+    self.assertIsInstance(await track2.recv(), int)
+
+  async def test_close_before_first_recv(self):
+    pc, track = self.connect()
+    await web.close_pc(pc)
+    self.assertEqual(track.readyState, "ended")
+    self.assertEqual(web.sources, {})
+
+    del pc, track
+    gc.collect()
+    self.assertIsNone(self.created[0]())
+
+    # the next connection opens a fresh source
+    self.connect()
+    self.assertEqual(len(self.created), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -12,7 +12,8 @@ warnings.resetwarnings()
 warnings.simplefilter("always")
 
 from aiohttp import web
-from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
 
 import cereal.messaging as messaging
 from openpilot.common.basedir import BASEDIR
@@ -21,10 +22,47 @@ from openpilot.tools.bodyteleop.bodyav import BodyMic, WebClientSpeaker, force_c
 logger = logging.getLogger("pc")
 logging.basicConfig(level=logging.INFO)
 
-pcs = set()
+pcs: set[RTCPeerConnection] = set()
 pm, sm = None, None
 TELEOPDIR = f"{BASEDIR}/tools/bodyteleop"
 
+# camera and mic producers are opened once and fanned out to every peer connection through
+# their own relay, both are dropped again when the last subscriber goes away
+sources: dict[str, tuple[MediaRelay, MediaStreamTrack]] = {}
+subscribers: dict[str, set[MediaStreamTrack]] = {}
+pc_tracks: dict[RTCPeerConnection, list[tuple[str, MediaStreamTrack]]] = {}
+
+
+def subscribe_shared(name, factory):
+  if name not in sources:
+    sources[name] = (MediaRelay(), factory())
+    subscribers[name] = set()
+  relay, source = sources[name]
+  # unbuffered, same as the conflated socket EncodedBodyVideo reads from: a peer that falls
+  # behind skips ahead to the latest packet instead of queueing up latency
+  track = relay.subscribe(source, buffered=False)
+  subscribers[name].add(track)
+  return track
+
+
+def unsubscribe_shared(name, track):
+  # closing the pc doesn't stop its sender tracks, so the relay proxy has to be stopped here
+  track.stop()
+  subscribers[name].discard(track)
+  if not subscribers[name]:
+    del subscribers[name]
+    # a running relay reader exits on its next recv, and the relay only holds on to the
+    # source until then, so it is dropped together with the source
+    _, source = sources.pop(name)
+    source.stop()
+
+
+async def close_pc(pc):
+  for name, track in pc_tracks.pop(pc, []):
+    unsubscribe_shared(name, track)
+  await pc.close()
+  pcs.discard(pc)
+
 
 async def index(request):
   content = open(TELEOPDIR + "/static/index.html", "r").read()
@@ -44,7 +82,7 @@ async def control_body(data, app):
   if (data['type'] == 'control_command') and (app['mutable_vals']['prev_command'] == [data['x'], data['y']] and data['x'] == 0 and data['y'] == 0):
     return
 
-  logger.info(str(data))
+  logger.debug("%s", data)
   x = max(-1.0, min(1.0, data['x']))
   y = max(-1.0, min(1.0, data['y']))
   dat = messaging.new_message('testJoystick')
@@ -121,34 +159,42 @@ async def offer(request):
   async def on_connectionstatechange():
     log_info("Connection state is %s", pc.connectionState)
     if pc.connectionState == "failed":
-      await pc.close()
-      pcs.discard(pc)
+      await close_pc(pc)
+
+  sinks = {"audio": speaker, "video": blackhole}
 
   @pc.on('track')
   def on_track(track):
     logger.info(f"Track received: {track.kind}")
-    if track.kind == "audio":
-      speaker.addTrack(track)
-    elif track.kind == "video":
-      blackhole.addTrack(track)
+    sink = sinks.get(track.kind)
+    if sink is None:
+      return
+    sink.addTrack(track)
 
     @track.on("ended")
     async def on_ended():
       log_info("Remote %s track ended", track.kind)
-      if track.kind == "audio":
-        await speaker.stop()
-      elif track.kind == "video":
-        await blackhole.stop()
-
-  video_sender = pc.addTrack(EncodedBodyVideo())
-  force_codec(pc, video_sender, forced_codec='video/H264')
-  _ = pc.addTrack(BodyMic())
-
-  await pc.setRemoteDescription(offer)
-  await speaker.start()
-  await blackhole.start()
-  answer = await pc.createAnswer()
-  await pc.setLocalDescription(answer)
+      await sink.stop()
+
+  # release the shared producers if negotiation fails or the request is cancelled
+  pc_tracks[pc] = []
+  try:
+    video_track = subscribe_shared('video', EncodedBodyVideo)
+    pc_tracks[pc].append(('video', video_track))
+    mic_track = subscribe_shared('mic', BodyMic)
+    pc_tracks[pc].append(('mic', mic_track))
+    video_sender = pc.addTrack(video_track)
+    force_codec(pc, video_sender, forced_codec='video/H264')
+    _ = pc.addTrack(mic_track)
+
+    await pc.setRemoteDescription(offer)
+    await speaker.start()
+    await blackhole.start()
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+  except BaseException:
+    await close_pc(pc)
+    raise
 
   return web.Response(
     content_type="application/json",
@@ -159,7 +205,7 @@ async def offer(request):
 
 
 async def on_shutdown(app):
-  coros = [pc.close() for pc in pcs]
+  coros = [close_pc(pc) for pc in list(pcs)]
   await asyncio.gather(*coros)
   pcs.clear()
 